@@ -1,16 +1,24 @@
+import argparse
+import asyncio
+import logging
 import feedparser
-import requests
-from bs4 import BeautifulSoup
+import aiohttp
+from lxml import etree
 import plotly.express as px
 import pandas as pd
 import os
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, func
+import re
+from collections import Counter
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, Index, event, func, select, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
-from wordcloud import WordCloud
+from wordcloud import WordCloud, STOPWORDS
 import matplotlib.pyplot as plt
 
+logger = logging.getLogger(__name__)
+
 Base = declarative_base()
 
 class Organisation(Base):
@@ -31,6 +39,22 @@ class Article(Base):
     organisation_id = Column(Integer, ForeignKey('organisations.id'))
     organisation = relationship('Organisation', back_populates='articles')
 
+    __table_args__ = (
+        Index('ix_articles_updated', 'updated'),
+        Index('ix_articles_org_updated', 'organisation_id', 'updated'),
+    )
+
+class FeedMeta(Base):
+    __tablename__ = 'feed_meta'
+    url = Column(String, primary_key=True)
+    etag = Column(String)
+    modified = Column(String)
+
+class WordFrequency(Base):
+    __tablename__ = 'word_frequencies'
+    word = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False)
+
 # Ensure data directory exists
 data_dir = 'data'
 if not os.path.exists(data_dir):
@@ -38,20 +62,74 @@ if not os.path.exists(data_dir):
 
 # Create SQLite engine
 engine = create_engine(f'sqlite:///{data_dir}/gov_uk_news.db')
+
+@event.listens_for(engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Tunes each new SQLite connection for fewer fsyncs and faster reads.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA cache_size=-65536')  # 64 MB page cache
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA mmap_size=268435456')  # 256 MB memory-mapped I/O
+    cursor.close()
+
 Base.metadata.create_all(engine)
+# create_all skips indexes on tables that already exist, so add any missing ones
+for index in Article.__table__.indexes:
+    index.create(engine, checkfirst=True)
 Session = sessionmaker(bind=engine)
 
+# Words of three or more letters, as counted for the wordcloud
+word_pattern = re.compile(r"[A-Za-z']{3,}")
+
+# Compiled once and reused for every article page
+govspeak_text = etree.XPath('string()')
+
+# Maximum number of simultaneous connections used when fetching article pages
+max_connections = 100
+max_connections_per_host = 32
+
+# Timeouts (in seconds) and retry policy for article requests
+request_timeout = aiohttp.ClientTimeout(sock_connect=3.05, sock_read=10)
+max_retries = 3
+retry_backoff_factor = 0.3
+retry_statuses = {429, 500, 502, 503, 504}
+
 def parse_feed(url):
     """
     Parses an Atom feed and extracts relevant information.
 
+    The ETag and Last-Modified values from the previous fetch are sent with the
+    request, so an unchanged feed comes back as a 304 and is not parsed again.
+
+    The new validators are returned rather than saved, so the caller can store
+    them with save_feed_meta in the same transaction as the entries' articles.
+
     Args:
       url: The URL of the Atom feed.
 
     Returns:
-      A list of dictionaries, where each dictionary represents a feed entry.
+      A tuple of a list of dictionaries, where each dictionary represents a feed
+      entry, and a dictionary of the feed's new etag and modified values (or None
+      if the feed has not changed or sent neither).
     """
-    feed = feedparser.parse(url)
+    session = Session()
+    feed_meta = session.get(FeedMeta, url) or FeedMeta(url=url)
+    session.close()
+
+    feed = feedparser.parse(url, etag=feed_meta.etag, modified=feed_meta.modified)
+
+    if feed.get('status') == 304:
+        logger.info("Feed has not changed since the last run.")
+        return [], None
+
+    validators = None
+    if feed.get('etag') or feed.get('modified'):
+        validators = {'etag': feed.get('etag'), 'modified': feed.get('modified')}
+
     entries = []
 
     for entry in feed.entries:
@@ -60,77 +138,248 @@ def parse_feed(url):
             'title': entry.title,
             'link': entry.link,
             'summary': entry.summary,
-            'updated': datetime.strptime(entry.updated, "%Y-%m-%dT%H:%M:%S%z")
+            'updated': datetime.fromisoformat(entry.updated)
         })
 
-    return entries
+    return entries, validators
+
+def save_feed_meta(connection, url, validators):
+    """
+    Stores the etag and modified values to send on the next fetch of a feed.
+
+    Args:
+      connection: The database connection to write with, inside a transaction.
+      url: The URL of the Atom feed.
+      validators: A dictionary of etag and modified values, as returned by parse_feed.
+    """
+    upsert = sqlite_insert(FeedMeta).values(url=url, **validators)
+    upsert = upsert.on_conflict_do_update(index_elements=[FeedMeta.url], set_=validators)
+    connection.execute(upsert)
+
+def extract_article_details(events, details):
+    """
+    Fills in body text and organisation from parser events on an article page.
+
+    Args:
+      events: (event, element) pairs from an lxml parser filtered to div and meta tags.
+      details: The dictionary to fill in with the body text and organisation.
+
+    Returns:
+      True once both the body text and organisation have been found.
+    """
+    for _, element in events:
+        if element.tag == 'meta':
+            # Extract organisation (this assumes the organisation is in a meta tag)
+            if element.get('name') == 'govuk:primary-publishing-organisation':
+                details['organisation'] = element.get('content')
+            element.clear()
+        elif details['body_text'] is None and 'gem-c-govspeak' in element.get('class', '').split():
+            # Extract body text (this might need adjustment based on the website structure)
+            details['body_text'] = govspeak_text(element).strip() or None
+
+    return details['body_text'] is not None and details['organisation'] is not None
+
+async def get_with_retries(http_session, url):
+    """
+    Sends a GET request, retrying with exponential backoff on connection errors
+    and on transient error statuses.
+
+    Args:
+      http_session: An aiohttp.ClientSession shared by all article fetches.
+      url: The URL to request.
 
-def get_article_details(url):
+    Returns:
+      The aiohttp.ClientResponse of the last attempt.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            response = await http_session.get(url)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == max_retries:
+                raise
+        else:
+            if response.status not in retry_statuses or attempt == max_retries:
+                return response
+            response.release()
+
+        await asyncio.sleep(retry_backoff_factor * 2 ** attempt)
+
+async def get_article_details(http_session, url):
     """
     Fetches an article from a given URL and extracts body text and organisation.
 
+    The page is parsed incrementally as it downloads, and parsing stops as soon as
+    both the body text and organisation have been found.
+
     Args:
+      http_session: An aiohttp.ClientSession shared by all article fetches.
       url: The URL of the article.
 
     Returns:
       A dictionary containing the body text and organisation.
     """
     details = {'body_text': None, 'organisation': None}
+    found = False
 
     try:
-        response = requests.get(url)
-        response.raise_for_status()  # Raise an exception for bad status codes
-
-        soup = BeautifulSoup(response.content, 'html.parser')
+        async with await get_with_retries(http_session, url) as response:
+            response.raise_for_status()  # Raise an exception for bad status codes
+
+            # Only div and meta elements are reported, and comments and processing
+            # instructions are dropped rather than built into the tree. The charset
+            # from the Content-Type header is used when present; otherwise libxml2
+            # falls back to the page's own meta charset.
+            parser = etree.HTMLPullParser(events=('end',), tag=('div', 'meta'), encoding=response.charset,
+                                          remove_comments=True, remove_pis=True)
+
+            # Keep draining the body after we are done so the connection can be reused
+            async for chunk in response.content.iter_any():
+                if not found:
+                    parser.feed(chunk)
+                    found = extract_article_details(parser.read_events(), details)
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning("Error fetching article: %s", e)
+        return None
 
-        # Extract body text (this might need adjustment based on the website structure)
+    if not found:
         try:
-            details['body_text'] = soup.find('div',
-                                             class_='gem-c-govspeak').get_text(
-                                                 strip=True)
-        except:
-            print(f"Error extracting body text from {url}")
+            parser.close()
+            extract_article_details(parser.read_events(), details)
+        except etree.LxmlError:
+            logger.warning("Error parsing article from %s", url)
 
-        # Extract organisation (this assumes the organisation is in a meta tag)
-        try:
-            details[
-                'organisation'] = soup.find(
-                    'meta', {
-                        'name': 'govuk:primary-publishing-organisation'
-                    })['content']
-        except:
-            print(f"Error extracting organisation from {url}")
-
-        return details
-
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching article: {e}")
-        return None
+    if details['body_text'] is None:
+        logger.warning("Error extracting body text from %s", url)
+    if details['organisation'] is None:
+        logger.warning("Error extracting organisation from %s", url)
 
-def create_organisation_plot():
+    return details
+
+async def fetch_articles(entries):
     """
-    Creates a bar plot of the number of articles per organisation using data from the database.
+    Fetches the details of several articles concurrently.
+
+    Args:
+      entries: A list of feed entry dictionaries.
+
+    Returns:
+      A list of (entry, details) tuples, in the same order as the entries.
+    """
+    # A single session keeps connections alive across all article fetches
+    connector = aiohttp.TCPConnector(limit=max_connections, limit_per_host=max_connections_per_host)
+    async with aiohttp.ClientSession(connector=connector,
+                                     timeout=request_timeout,
+                                     headers={'Accept-Encoding': 'gzip'}) as http_session:
+        details = await asyncio.gather(*(get_article_details(http_session, entry['link']) for entry in entries))
+    return list(zip(entries, details))
+
+def store_articles(connection, results):
+    """
+    Inserts newly fetched articles and their organisations in bulk, using Core
+    statements so no ORM objects are built.
+
+    Args:
+      connection: The database connection to write with, inside a transaction.
+      results: A list of (entry, details) tuples as returned by fetch_articles.
+    """
+    if not results:
+        return
+
+    # Look up each distinct organisation once, inserting only those not yet in the database
+    names = {details['organisation'] for _, details in results if details['organisation']}
+    org_map = {}
+    if names:
+        org_map = dict(connection.execute(select(Organisation.name, Organisation.id).where(Organisation.name.in_(names))).all())
+        missing = names - org_map.keys()
+        if missing:
+            connection.execute(sqlite_insert(Organisation).on_conflict_do_nothing(), [{'name': name} for name in missing])
+            org_map.update(connection.execute(select(Organisation.name, Organisation.id).where(Organisation.name.in_(missing))).all())
+
+    connection.execute(Article.__table__.insert(), [
+        {
+            'feed_id': entry['id'],
+            'title': entry['title'],
+            'link': entry['link'],
+            'summary': entry['summary'],
+            'updated': entry['updated'],
+            'body_text': details['body_text'],
+            'organisation_id': org_map.get(details['organisation']),
+        }
+        for entry, details in results
+    ])
+
+    update_word_frequencies(connection, (details['body_text'] for _, details in results))
+
+    # Refresh planner statistics so the plot queries pick up the indexes
+    connection.execute(text('PRAGMA analysis_limit=400'))
+    connection.execute(text('PRAGMA optimize'))
+
+def tokenize(body_text):
+    """
+    Splits article text into lowercase words, dropping common English stopwords.
+
+    Args:
+      body_text: The text to tokenize.
+
+    Returns:
+      A list of words.
+    """
+    words = (word.lower() for word in word_pattern.findall(body_text))
+    return [word for word in words if word not in STOPWORDS]
+
+def update_word_frequencies(connection, body_texts):
+    """
+    Adds the words in the given article texts to the stored word frequencies.
+
+    Args:
+      connection: The database connection or session to write with.
+      body_texts: An iterable of article body texts, which may contain None.
+    """
+    word_counts = Counter()
+    for body_text in body_texts:
+        if body_text:
+            word_counts.update(tokenize(body_text))
+
+    if not word_counts:
+        return
+
+    upsert = sqlite_insert(WordFrequency)
+    upsert = upsert.on_conflict_do_update(index_elements=[WordFrequency.word],
+                                          set_={'count': WordFrequency.count + upsert.excluded.count})
+    connection.execute(upsert, [{'word': word, 'count': count} for word, count in word_counts.items()])
+
+def backfill_word_frequencies():
+    """
+    Populates the word frequencies from existing articles if they have not been counted yet.
     """
     session = Session()
 
-    # Query the database to get the count of articles per organisation
-    org_counts = session.query(Organisation.name, func.count(Article.id)).join(Article).group_by(Organisation.name).all()
+    if session.query(WordFrequency.word).first() is None:
+        body_texts = (body_text for (body_text,) in session.query(Article.body_text).yield_per(1000))
+        update_word_frequencies(session, body_texts)
+        session.commit()
 
     session.close()
 
-    # Convert the query result to a pandas Series
-    org_counts_series = pd.Series(dict(org_counts))
-
-    # Sort the Series in descending order
-    org_counts_series = org_counts_series.sort_values(ascending=False)
+def create_organisation_plot():
+    """
+    Creates a bar plot of the number of articles per organisation using data from the database.
+    """
+    # Query the database to get the count of articles per organisation, sorted in descending order
+    article_count = func.count(Article.id).label('Count')
+    query = select(Organisation.name.label('Organisation'), article_count)\
+        .join(Article)\
+        .group_by(Organisation.name)\
+        .order_by(article_count.desc())
+    df = pd.read_sql_query(query, engine)
 
     # Create bar chart using Plotly Express with beautiful settings and sorted data
-    fig = px.bar(x=org_counts_series.index,
-                 y=org_counts_series.values,
-                 labels={'x': 'Organisation', 'y': 'Number of Articles'},
+    fig = px.bar(df, x='Organisation', y='Count',
+                 labels={'Count': 'Number of Articles'},
                  title='Number of Articles per Organisation',
                  template="plotly_white",  # Use a clean template
-                 color=org_counts_series.index,  # Color bars by organization
+                 color='Organisation',  # Color bars by organization
                  color_discrete_sequence=px.colors.qualitative.Pastel,  # Use a pastel color palette
                  )
 
@@ -147,16 +396,12 @@ def create_daily_releases_plot():
     """
     Creates a line plot of the total releases per day.
     """
-    session = Session()
-
     # Query the database to get the count of articles per day
-    daily_counts = session.query(func.date(Article.updated), func.count(Article.id)).group_by(func.date(Article.updated)).all()
-
-    session.close()
-
-    # Convert the query result to a pandas DataFrame
-    df = pd.DataFrame(daily_counts, columns=['Date', 'Count'])
-    df['Date'] = pd.to_datetime(df['Date'])
+    day = func.date(Article.updated).label('Date')
+    query = select(day, func.count(Article.id).label('Count'))\
+        .group_by(day)\
+        .order_by(day)
+    df = pd.read_sql_query(query, engine, parse_dates=['Date'])
 
     # Create line chart using Plotly Express
     fig = px.line(df, x='Date', y='Count',
@@ -170,28 +415,27 @@ def create_daily_releases_plot():
 
     fig.show()
 
-def create_daily_releases_by_org_plot():
+def create_daily_releases_by_org_plot(days=90):
     """
     Creates a line plot of the total releases per day, colored by organisation.
-    """
-    session = Session()
 
+    Args:
+      days: Only articles updated within this many days of now are plotted.
+    """
     # Query the database to get the count of articles per day per organisation
-    daily_org_counts = session.query(func.date(Article.updated), Organisation.name, func.count(Article.id))\
+    day = func.date(Article.updated).label('Date')
+    query = select(day, Organisation.name.label('Organisation'), func.count(Article.id).label('Count'))\
         .join(Organisation)\
-        .group_by(func.date(Article.updated), Organisation.name)\
-        .all()
-
-    session.close()
-
-    # Convert the query result to a pandas DataFrame
-    df = pd.DataFrame(daily_org_counts, columns=['Date', 'Organisation', 'Count'])
-    df['Date'] = pd.to_datetime(df['Date'])
+        .where(Article.updated >= func.datetime('now', f'-{int(days)} days'))\
+        .group_by(day, Organisation.name)\
+        .order_by(day)
+    df = pd.read_sql_query(query, engine, parse_dates=['Date'])\
+        .astype({'Organisation': 'category', 'Count': 'int32'})
 
     # Create line chart using Plotly Express
     fig = px.line(df, x='Date', y='Count', color='Organisation',
                   labels={'Count': 'Number of Releases'},
-                  title='Total Releases per Day by Organisation',
+                  title=f'Total Releases per Day by Organisation (Last {days} Days)',
                   template="plotly_white")
 
     fig.update_layout(
@@ -204,28 +448,24 @@ def create_hourly_releases_plot():
     """
     Creates a bar plot of the total releases by hour of the day.
     """
-    session = Session()
-
-    # Query the database to get the count of articles by hour
-    hourly_counts = session.query(func.extract('hour', Article.updated), func.count(Article.id))\
-        .group_by(func.extract('hour', Article.updated))\
-        .all()
-
-    session.close()
-
-    # Convert the query result to a pandas DataFrame
-    df = pd.DataFrame(hourly_counts, columns=['Hour', 'Count'])
-    df['Hour'] = df['Hour'].astype(int)
-
-    # Create a DataFrame with all 24 hours
-    all_hours = pd.DataFrame({'Hour': range(24)})
-    
-    # Merge with the existing data, filling missing values with 0
-    df = all_hours.merge(df, on='Hour', how='left').fillna(0)
-    df = df.sort_values('Hour')
-
-    # Convert Hour to time range
-    df['Time Range'] = df['Hour'].apply(lambda x: f"{x:02d}:00 - {(x+1)%24:02d}:00")
+    # Query the database to get the count of articles for each of the 24 hours,
+    # filling empty hours with 0 and labelling each hour as a time range
+    query = text("""
+        WITH RECURSIVE hours(hour) AS (
+            SELECT 0 UNION ALL SELECT hour + 1 FROM hours WHERE hour < 23
+        )
+        SELECT printf('%02d:00 - %02d:00', hours.hour, (hours.hour + 1) % 24) AS "Time Range",
+               COALESCE(counts.count, 0) AS "Count"
+        FROM hours
+        LEFT JOIN (
+            SELECT CAST(strftime('%H', updated) AS INTEGER) AS hour, COUNT(*) AS count
+            FROM articles
+            WHERE updated IS NOT NULL
+            GROUP BY hour
+        ) AS counts ON counts.hour = hours.hour
+        ORDER BY hours.hour
+    """)
+    df = pd.read_sql_query(query, engine)
 
     # Create bar chart using Plotly Express
     fig = px.bar(df, x='Time Range', y='Count',
@@ -247,16 +487,13 @@ def create_wordcloud():
     """
     session = Session()
 
-    # Query the database to get all body texts
-    body_texts = session.query(Article.body_text).all()
+    # Word counts are maintained at ingest time, so this is a single table read
+    word_counts = dict(session.query(WordFrequency.word, WordFrequency.count).all())
 
     session.close()
 
-    # Combine all body texts into a single string
-    text = ' '.join([body[0] for body in body_texts if body[0] is not None])
-
     # Create and generate a word cloud image
-    wordcloud = WordCloud(width=800, height=400, background_color='white').generate(text)
+    wordcloud = WordCloud(width=800, height=400, background_color='white').generate_from_frequencies(word_counts)
 
     # Display the generated image
     plt.figure(figsize=(10, 5))
@@ -266,81 +503,71 @@ def create_wordcloud():
     plt.show()
     
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch Gov UK news articles and plot them.")
+    parser.add_argument('-v', '--verbose', action='store_true', help="log details of every article")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    # Only this module's logger goes to DEBUG, so library debug output stays hidden
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
     feed_url = "https://www.gov.uk/search/news-and-communications.atom"
-    entries = parse_feed(feed_url)
+    entries, validators = parse_feed(feed_url)
 
     total_articles = len(entries)
     existing_articles = 0
     new_articles = 0
     partial_failure_count = 0
 
-    session = Session()
+    backfill_word_frequencies()
+
+    # Check which articles already exist in the database with a single query
+    feed_ids = [entry['id'] for entry in entries]
+    with engine.connect() as connection:
+        existing_ids = set(connection.scalars(select(Article.feed_id).where(Article.feed_id.in_(feed_ids))))
 
+    to_fetch = []
     for entry in entries:
-        print(f"Title: {entry['title']}")
-        print(f"Link: {entry['link']}")
-        print(f"Summary: {entry['summary']}")
-        print(f"Updated: {entry['updated']}")
-
-        # Check if article already exists in database
-        existing_article = session.query(Article).filter_by(feed_id=entry['id']).first()
-        if existing_article:
-            print("Article already exists in database. Skipping...")
+        if entry['id'] in existing_ids:
+            logger.debug("Article already exists in database. Skipping: %s", entry['title'])
             existing_articles += 1
-            continue
+        else:
+            to_fetch.append(entry)
+            # A repeat of this id later in the feed is then skipped as existing
+            existing_ids.add(entry['id'])
 
+    # Fetch new articles concurrently, then write them to the database in bulk
+    results = []
+    for entry, details in asyncio.run(fetch_articles(to_fetch)):
         new_articles += 1
-        details = get_article_details(entry['link'])
         if details:
             if details['body_text'] is None or details['organisation'] is None:
                 partial_failure_count += 1
-            print(f"Body Text: {details['body_text'][:100] if details['body_text'] else 'Not available'}...")
-            print(f"Organisation: {details['organisation'] if details['organisation'] else 'Not available'}")
-
-            # Get or create organisation
-            if details['organisation']:
-                organisation = session.query(Organisation).filter_by(name=details['organisation']).first()
-                if not organisation:
-                    organisation = Organisation(name=details['organisation'])
-                    session.add(organisation)
-            else:
-                organisation = None
-
-            # Create new article
-            new_article = Article(
-                feed_id=entry['id'],
-                title=entry['title'],
-                link=entry['link'],
-                summary=entry['summary'],
-                updated=entry['updated'],
-                body_text=details['body_text'],
-                organisation=organisation
-            )
-            session.add(new_article)
         else:
             partial_failure_count += 1
-            # Create new article with null values for failed parsing
-            new_article = Article(
-                feed_id=entry['id'],
-                title=entry['title'],
-                link=entry['link'],
-                summary=entry['summary'],
-                updated=entry['updated'],
-                body_text=None,
-                organisation=None
-            )
-            session.add(new_article)
-
-        print("-" * 20)
-
-    session.commit()
-    session.close()
-
-    print("\nSummary:")
-    print(f"Total articles in feed: {total_articles}")
-    print(f"Articles already in database: {existing_articles}")
-    print(f"New articles added: {new_articles}")
-    print(f"Articles with some parsing failure: {partial_failure_count}")
+            # Store the article with null values for failed parsing
+            details = {'body_text': None, 'organisation': None}
+        results.append((entry, details))
+
+        logger.debug("Title: %s\nLink: %s\nSummary: %s\nUpdated: %s\nBody Text: %.100s...\nOrganisation: %s\n%s",
+                     entry['title'], entry['link'], entry['summary'], entry['updated'],
+                     details['body_text'] or 'Not available', details['organisation'] or 'Not available',
+                     "-" * 20)
+
+    # Write everything in a single transaction, so the feed's validators only
+    # move forward once its articles have been stored
+    with engine.begin() as connection:
+        store_articles(connection, results)
+        if validators:
+            save_feed_meta(connection, feed_url, validators)
+
+    logger.info("\nSummary:\n"
+                "Total articles in feed: %d\n"
+                "Articles already in database: %d\n"
+                "New articles added: %d\n"
+                "Articles with some parsing failure: %d",
+                total_articles, existing_articles, new_articles, partial_failure_count)
 
     # Create and show the plots
     create_organisation_plot()